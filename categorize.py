@@ -12,54 +12,89 @@ Sorting can be directly invoked by running this file:
 """
 
 import hashlib
-import itertools
 import logging
 import math
 import numpy as np
 import re
+import string
 
 import common
 from paragraphs import generate_paragraphs_from_text
 
 SIGNATURE_HASH_BUCKETS = 1000000
+SIGNATURE_WORDS = SIGNATURE_HASH_BUCKETS // 64  # signature bits are packed into 64-bit words
+COMPARISON_BLOCK_ROWS = 256  # signatures compared at once when building the distance matrix
 
 
-def get_text_shingles(text, default_shingle_length=8):
-    for i in range(0, 1 + len(text) - default_shingle_length):
-        shingle = text[i:(i + default_shingle_length)]
-        yield shingle
+def get_text_shingle_indices(text, default_shingle_length=8):
+    # code points of the text, so each shingle is default_shingle_length characters
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    count = 1 + len(codes) - default_shingle_length
+    if count <= 0:
+        return np.zeros((0, ), dtype=np.uint64)
+
+    # polynomial hash of every shingle at once, one vectorized pass per character offset
+    hashes = np.zeros((count, ), dtype=np.uint64)
+    for offset in range(default_shingle_length):
+        hashes *= np.uint64(1000003)
+        hashes += codes[offset:(offset + count)]
+
+    # mix bits (murmur3 finalizer) so the modulo sees a uniform distribution
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xff51afd7ed558ccd)
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xc4ceb9fe1a85ec53)
+    hashes ^= hashes >> np.uint64(33)
+
+    return hashes % np.uint64(SIGNATURE_HASH_BUCKETS)
+
+
+def popcount(x):
+    # number of set bits in each element of a uint64 array
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+
+    # SWAR fallback for NumPy < 2.0
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
 
 
 def calculate_mini_signatures(signature, rows_per_band=10000):
     miniSignature = []
-    signatureLength = len(signature)
+
+    # bands are measured in signature rows (bits), so unpack the words to slice on the same boundaries
+    rows = np.unpackbits(signature.astype('<u8').view(np.uint8), bitorder='little')
+    signatureLength = len(rows)
 
     for start in range(0, signatureLength, rows_per_band):
         end = start + rows_per_band
-        if np.any(signature[start:end]):
-            band = signature[start:end].tobytes()
-            hashedBand = hashlib.md5(band).hexdigest()
+        band = rows[start:end]
+        if np.any(band):
+            # hash the band packed back into bytes, no hex round trip
+            hashedBand = int.from_bytes(hashlib.blake2b(np.packbits(band), digest_size=8).digest(), 'little')
             miniSignature.append(hashedBand)
         else:
             miniSignature.append(0)
 
-    return miniSignature
+    # empty bands are marked with 0
+    return np.array(miniSignature, dtype=np.uint64)
 
 
 def calculate_signature(text):
-    signature = np.zeros((SIGNATURE_HASH_BUCKETS, ), dtype=np.bool_)
+    signature = np.zeros((SIGNATURE_WORDS, ), dtype=np.uint64)
 
-    for shingle in set(get_text_shingles(text)):
-        # run once per shingle, to minimize hashing
-        index = int(hashlib.md5(shingle.encode('utf-8')).hexdigest(), 16) % SIGNATURE_HASH_BUCKETS
-        signature[index] = True
+    # set the bit of every shingle (repeated shingles just set the same bit)
+    indices = get_text_shingle_indices(text)
+    np.bitwise_or.at(signature, indices >> np.uint64(6), np.uint64(1) << (indices & np.uint64(63)))
 
     return signature
 
 
 def compare_signatures(x, y):
-    intersection = np.bitwise_and(x, y).sum()
-    union = np.bitwise_or(x, y).sum()
+    intersection = popcount(np.bitwise_and(x, y)).sum()
+    union = popcount(np.bitwise_or(x, y)).sum()
 
     try:
         jaccard = float(intersection) / float(union)
@@ -70,86 +105,83 @@ def compare_signatures(x, y):
 
 
 def calculate_express_signature(text):
-    ret = set()
-
-    for shingle in set(get_text_shingles(text)):
-        # run once per shingle, to minimize hashing
-        index = int(hashlib.md5(shingle.encode('utf-8')).hexdigest(), 16) % SIGNATURE_HASH_BUCKETS
-        ret.add(index)
-
-    return ret
+    # same shingle indices as calculate_signature, hashed in one vectorized call (sorted and unique)
+    return np.unique(get_text_shingle_indices(text).astype(np.int64))
 
 
 def compare_express_signatures(x, y):
-    z = x.intersection(y)
-    len_z = len(z)
+    len_z = np.intersect1d(x, y, assume_unique=True).size
     # union is the length of each signature minus the length of the intersection
-    return float(len_z) / (len(x) + len(y) - len_z)
+    return float(len_z) / (x.size + y.size - len_z)
 
 
 def compare_mini_signatures(x, y):
-
-    for index, signature in enumerate(x):
-        if x[index] == y[index] and x[index] != 0:
-            return True
-
-    return False
+    # any matching band, ignoring empty bands
+    return bool(np.any((x == y) & (x != 0)))
 
 
 re_strip_headings = re.compile(r'^#+ ')  # strip markdown headings
 re_strip_format = re.compile(r' \*{1,2}([^\*]+)\*{1,2} ')  # strip markdown bold and italic
 re_strip_links = re.compile(r'\[([^\]]+)\]\(https?://[^)]+\)', flags=re.IGNORECASE)  # strip markdown links'
-re_non_letters = re.compile(r'[^a-zA-Z]*')
+non_letter_bytes = bytes(range(256)).translate(None, string.ascii_letters.encode('ascii'))  # everything but a-zA-Z
+
+
+def clean_paragraph(paragraph):
+    # clean markdown (per paragraph, so links and formatting never match across paragraphs)
+    text = re_strip_headings.sub('', paragraph)
+    text = re_strip_format.sub(r' \1 ', text)
+    return re_strip_links.sub(r'\1', text)
 
 
 def clean_text(text):
-    output = ''
-    for paragraph in generate_paragraphs_from_text(text):
-        # clean markdown
-        text = re_strip_headings.sub('', paragraph)
-        text = re_strip_format.sub(r' \1 ', text)
-        text = re_strip_links.sub(r'\1', text)
+    # join paragraphs once, rather than growing the output string paragraph by paragraph
+    text = ''.join(clean_paragraph(paragraph) for paragraph in generate_paragraphs_from_text(text))
 
-        # delete anything that is not a letter
-        output = output + re_non_letters.sub('', text)
+    # delete anything that is not a letter (non-ASCII characters are dropped by the encoding)
+    return text.encode('ascii', 'ignore').translate(None, non_letter_bytes).decode('ascii')
 
-    return output
 
+def path_distance(route, distance):
+    total_distance = 1e-7 # epsilon
 
-def sort_articles_by_similarity(db_conn, db_cursor):
-    def path_distance(route, distance):
-        total_distance = 1e-7 # epsilon
-
-        # map indices to article IDs
-        for stop_index, node in enumerate(route[0:-1]):
-            a = route[stop_index]
-            b = route[stop_index+1]
-
-            total_distance += distance[a][b]
-
-        return total_distance
-
-    # Reverse the order of all elements from element i to element k in array r.
-    two_opt_swap = lambda r, i, k: np.concatenate((r[0:i], r[k:-len(r) + i - 1:-1], r[k + 1:len(r)]))
-
-    # https://stackoverflow.com/questions/25585401/travelling-salesman-in-scipy
-    def two_opt(nodes, distance, improvement_threshold):  # 2-opt Algorithm adapted from https://en.wikipedia.org/wiki/2-opt
-        route = np.arange(len(nodes))  # Make an array of row numbers corresponding to nodes.
-        improvement_factor = 1  # Initialize the improvement factor.
-        best_distance = path_distance(route, distance)  # Calculate the distance of the initial path.
-        while improvement_factor > improvement_threshold:  # If the route is still improving, keep going!
-            distance_to_beat = best_distance  # Record the distance at the beginning of the loop.
-            for swap_first in range(1, len(route) - 2):  # From each city except the first and last,
-                for swap_last in range(swap_first + 1, len(route)):  # to each of the nodes following,
-                    new_route = two_opt_swap(route, swap_first, swap_last)  # try reversing the order of these nodes
-                    new_distance = path_distance(new_route, distance)  # and check the total distance with this modification.
-                    if new_distance < best_distance:  # If the path distance is an improvement,
-                        route = new_route  # make this the accepted best route
-                        best_distance = new_distance  # and update the distance corresponding to this route.
-            improvement_factor = 1 - best_distance / distance_to_beat  # Calculate how much the route has improved.
-
-        return route  # When the route is no longer improving substantially, stop searching and return the route.
+    # sum the distance between consecutive stops
+    total_distance += distance[route[0:-1], route[1:]].sum()
+
+    return total_distance
+
+
+# https://stackoverflow.com/questions/25585401/travelling-salesman-in-scipy
+def two_opt(distance, improvement_threshold):  # 2-opt Algorithm adapted from https://en.wikipedia.org/wiki/2-opt
+    count = len(distance)
+    route = np.arange(count)  # Make an array of row numbers corresponding to nodes.
+    improvement_factor = 1  # Initialize the improvement factor.
+    best_distance = path_distance(route, distance)  # Calculate the distance of the initial path.
+    while improvement_factor > improvement_threshold:  # If the route is still improving, keep going!
+        distance_to_beat = best_distance  # Record the distance at the beginning of the loop.
+        for swap_first in range(1, count - 2):  # From each city except the first and last,
+            swap_last = swap_first + 1
+            while swap_last < count:  # to each of the nodes following,
+                # Reversing route[swap_first:k + 1] only changes the edges at both ends of the reversed
+                # segment, so the change in distance is calculated in constant time for every k at once.
+                last = np.arange(swap_last, count)
+                delta = distance[route[swap_first - 1], route[last]] - distance[route[swap_first - 1], route[swap_first]]
+                delta[:-1] += distance[route[swap_first], route[last[:-1] + 1]] - distance[route[last[:-1]], route[last[:-1] + 1]]
+
+                # Take the first improvement, as if checking each k in order.
+                improved = np.flatnonzero(delta < 0)
+                if len(improved) == 0:
+                    break
+
+                swap_last = last[improved[0]]
+                route[swap_first:swap_last + 1] = route[swap_first:swap_last + 1][::-1]  # reverse in place to make the accepted best route
+                best_distance += delta[improved[0]]  # and update the distance corresponding to this route.
+                swap_last += 1
+        improvement_factor = 1 - best_distance / distance_to_beat  # Calculate how much the route has improved.
 
+    return route  # When the route is no longer improving substantially, stop searching and return the route.
+
+
+def sort_articles_by_similarity(db_conn, db_cursor):
     # get unreviewed and unsorted articles
     logging.debug('Fetching crawler content for sorting')
     db_cursor.execute('SELECT cq.ID AS QueueID, cc.Text AS Text FROM CrawlerQueue AS cq, CrawlerContent AS cc '
@@ -163,36 +195,47 @@ def sort_articles_by_similarity(db_conn, db_cursor):
     unreviewed_articles_ids = [x['QueueID'] for x in unreviewed_articles]
     logging.debug('Found %d articles', len(unreviewed_articles_ids))
 
-    distance = np.zeros((len(unreviewed_articles_ids), len(unreviewed_articles_ids)))
+    # calculate each signature once, one row per article (only a short preview of each text is kept for logging)
+    signatures = np.zeros((len(unreviewed_articles_ids), SIGNATURE_WORDS), dtype=np.uint64)
+    signature_rows = {}
+    previews = []
+    for index, article in enumerate(unreviewed_articles):
+        article_text = article['Text']
+        previews.append(''.join(article_text[0:160].splitlines()))
 
-    # for all pairwise combinations of article IDs...
-    for comparison in itertools.combinations(unreviewed_articles_ids, 2):
+        text = clean_text(article_text)
 
-        index_a = comparison[0]
-        index_b = comparison[1]
+        # syndicated articles often share the same text, reuse their signature
+        text_hash = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        if text_hash in signature_rows:
+            signatures[index] = signatures[signature_rows[text_hash]]
+        else:
+            signatures[index] = calculate_signature(text)
+            signature_rows[text_hash] = index
 
-        text = next(x for x in unreviewed_articles if x['QueueID'] == index_a)['Text']
-        signature_a = calculate_signature(clean_text(text))
+    # texts are no longer needed
+    del unreviewed_articles
 
-        text = next(x for x in unreviewed_articles if x['QueueID'] == index_b)['Text']
-        signature_b = calculate_signature(clean_text(text))
+    distance = np.zeros((len(unreviewed_articles_ids), len(unreviewed_articles_ids)))
 
-        try:
-            similarity = compare_signatures(signature_a, signature_b)
+    # compare each article against the following articles, a block of rows at a time so the temporary arrays
+    # stay the same size however many articles there are
+    for index in range(len(unreviewed_articles_ids) - 1):
+        for start in range(index + 1, len(unreviewed_articles_ids), COMPARISON_BLOCK_ROWS):
+            end = start + COMPARISON_BLOCK_ROWS
+            intersection = popcount(np.bitwise_and(signatures[index], signatures[start:end])).sum(axis=1)
+            union = popcount(np.bitwise_or(signatures[index], signatures[start:end])).sum(axis=1)
 
-            matrix_index_a = unreviewed_articles_ids.index(index_a)
-            matrix_index_b = unreviewed_articles_ids.index(index_b)
-            distance[matrix_index_a][matrix_index_b] = 1 - similarity
-            distance[matrix_index_b][matrix_index_a] = 1 - similarity
+            # if there is no text, the union is empty and the similarity is zero (as in compare_signatures)
+            similarity = np.divide(intersection, union, out=np.zeros(intersection.shape), where=union > 0)
 
-        # if there is no text, we'll give a division by zero error from the compare_signatures function
-        except ZeroDivisionError:
-            logging.error('Division by zero while sorting pair: (%d, %d)', index_a, index_b)
+            distance[index, start:end] = 1 - similarity
+            distance[start:end, index] = 1 - similarity
 
     logging.info('Calculated distance matrix for sorting articles')
 
     # Find a good route with 2-opt ("route" gives the order in which to travel to each city by row number.)
-    route = two_opt(unreviewed_articles_ids, distance, 0.0001)
+    route = two_opt(distance, 0.0001)
     logging.info('Calculated optimal path for sorting articles')
 
     to_update = []
@@ -208,22 +251,22 @@ def sort_articles_by_similarity(db_conn, db_cursor):
 
     previous_article_index = None
     for index, article_index in enumerate(route):
-        article = next(x for x in unreviewed_articles if x['QueueID'] == unreviewed_articles_ids[article_index])
+        queue_id = unreviewed_articles_ids[article_index]
 
         if previous_article_index is None:
-            logging.debug('%d, %d, %s', index, article['QueueID'], ''.join(article['Text'][0:160].splitlines()))
+            logging.debug('%d, %d, %s', index, queue_id, previews[article_index])
         else:
             a_b_distance = distance[previous_article_index][article_index]
             logging.debug('%f, %d, %d, %s',
                           a_b_distance,
                           index,
-                          article['QueueID'],
-                          ''.join(article['Text'][0:160].splitlines()))
+                          queue_id,
+                          previews[article_index])
 
         previous_article_index = article_index
 
         category = '%%0%dd' % digits % (index + article_offset)
-        to_update.append((category, article['QueueID']))
+        to_update.append((category, queue_id))
 
     # set category for duplicates
     db_cursor.executemany('UPDATE CrawlerQueue SET Category = ? WHERE ID = ?', to_update)
@@ -239,7 +282,7 @@ def sort_articles_by_similarity(db_conn, db_cursor):
 
 def main():
     # connect to database
-    db_connection = common.get_db_connection(local=True)
+    db_connection = common.get_db_connection()
     db_cursor = db_connection.cursor()
 
     # assign mini signatures to articles and group articles together
@@ -5,12 +5,26 @@ Code for instantiating database connection.
 """
 
 import sqlite3 as db
+from urllib.request import pathname2url
 
 from config import Config
 
 
-def get_db_connection():
+def get_db_connection(read_only=False):
     c = Config()
+
+    if read_only:
+        # read only connection, skips journal writes and locking for writes
+        conn = db.connect('file:%s?mode=ro' % pathname2url(c.sqlite_db), uri=True)
+        conn.row_factory = db.Row
+        conn.execute('PRAGMA query_only=1')
+        return conn
+
     conn = db.connect(c.sqlite_db)
     conn.row_factory = db.Row
+
+    # write ahead log, so commits only sync at checkpoints
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+
     return conn
@@ -19,12 +19,15 @@ Crawling can be invoked by calling:
 # noinspection PyUnresolvedReferences
 import log_file  # enable file logging by default (must be first import)
 import abc
-from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import html
 import re
 import urllib
 import logging
+import lxml.etree
+import lxml.html
 import requests
 from ftfy import fix_encoding
 import sqlite3 as db
@@ -40,6 +43,9 @@ space_regex = re.compile(r'\s+')
 content_type_regex = re.compile(r'\btext/.+', re.IGNORECASE)
 anchor_regex = re.compile('#.+')
 clean_url_regex = re.compile('&TM=[.0-9]+$')  # strip unneeded parameters from the URL
+fetch_workers = 16  # number of URLs fetched in parallel
+commit_batch_size = 100  # number of articles saved per commit
+link_parser = lxml.html.HTMLParser(encoding='utf-8')  # decodes the re-encoded response text
 
 
 class CrawlerConfiguration(object):
@@ -106,23 +112,29 @@ class CountLoveConfiguration(CrawlerConfiguration):
         self.db_conn = db_conn
         self.db_cursor = db_cursor
 
+        # results to insert at the end of the crawl
+        self.pending_results = []
+
     def start_crawl(self):
         super(CountLoveConfiguration, self).start_crawl()
 
         # store date string
         self.date_string = datetime.today().strftime('%Y-%m-%d')
+        self.pending_results = []
 
     def end_crawl(self):
         super(CountLoveConfiguration, self).end_crawl()
 
+        # bulk insert
+        self.db_cursor.executemany('INSERT OR IGNORE INTO `CrawlerQueue` '
+                                   '(`Date`, `Name`, `Location`, `SourceID`, `Source`, `SourceHash`) VALUES '
+                                   '(?, ?, ?, ?, ?, ?)', self.pending_results)
+        self.pending_results = []
+
         self.db_conn.commit()
 
     def add_result(self, source_id, title, link, location):
-        # bulk update
-        self.db_cursor.execute('INSERT OR IGNORE INTO `CrawlerQueue` '
-                               '(`Date`, `Name`, `Location`, `SourceID`, `Source`, `SourceHash`) VALUES '
-                               '(?, ?, ?, ?, ?, ?)',
-                               (self.date_string, title, location, source_id, link, md5(link)))
+        self.pending_results.append((self.date_string, title, location, source_id, link, md5(link)))
 
 
 class Crawler(object):
@@ -132,6 +144,9 @@ class Crawler(object):
         self.db_conn = db_conn
         self.db_cursor = db_cursor
 
+        # shared by fetch threads, reuses connections
+        self.session = make_session()
+
     def add_config(self, config):
         self.configs.append(config)
 
@@ -146,22 +161,26 @@ class Crawler(object):
         # successfully cralwed
         successfully_crawled = []
 
-        maxi = len(to_crawl)
-        for i, (id, url, location) in enumerate(to_crawl):
-            logging.debug('%05d/%05d: %s (%s)' % (i, maxi, url[0:24], location))
-
-            # crawl it
-            url, response = fetch_url(url)
-
-            # process response
-            if response is not None:
-                success = self._process_response(id, url, location, response)
-            else:
-                success = False
-
-            # if success?
-            if success:
-                successfully_crawled.append((datetime.now(), id))
+        try:
+            # crawl them in parallel, responses are processed in order on this thread
+            responses = fetch_urls([x[1] for x in to_crawl], self.session)
+
+            maxi = len(to_crawl)
+            for i, ((id, request_url, location), (url, response)) in enumerate(zip(to_crawl, responses)):
+                logging.debug('%05d/%05d: %s (%s)' % (i, maxi, request_url[0:24], location))
+
+                # process response
+                if response is not None:
+                    success = self._process_response(id, url, location, response)
+                else:
+                    success = False
+
+                # if success?
+                if success:
+                    successfully_crawled.append((datetime.now(), id))
+        finally:
+            # release the pooled connections
+            self.session.close()
 
         # signal end of crawl
         for config in self.configs:
@@ -187,21 +206,30 @@ class Crawler(object):
         return clean_url_regex.sub('', url)
 
     def _process_response(self, id, url, location, response):
-        # parse HTML into a BeautifulSoup document
+        # parse HTML with lxml (only links are needed, so there is no need for a BeautifulSoup document)
         try:
-            soup = BeautifulSoup(response, 'lxml')
+            document = lxml.html.document_fromstring(response.encode('utf-8'), parser=link_parser)
+        except lxml.etree.ParserError:
+            # empty page (blank, or only a comment or doctype), no links
+            return True
         except Exception as e:
             logging.error('Parsing error for %s: %s', url, e)
             return False
 
+        # drop script, style and template contents, so link text matches BeautifulSoup's get_text
+        lxml.etree.strip_elements(document, 'script', 'style', 'template', with_tail=False)
+
         # for each configuration
         for config in self.configs:
             unique_urls = set()
 
             # extract links that contain words of interest
-            for link in soup.find_all('a', attrs={'href': True}):
+            for link in document.iter('a'):
+                if link.get('href') is None:
+                    continue
+
                 # get link text
-                link_text = html.unescape(link.get_text()).strip()
+                link_text = html.unescape(link.text_content()).strip()
 
                 # clean link text
                 link_text = space_regex.sub(' ', link_text)
@@ -215,7 +243,7 @@ class Crawler(object):
                     continue
 
                 # link href
-                link_href = link['href'].strip()
+                link_href = link.get('href').strip()
 
                 # turn into an absolute link
                 link_href = urllib.parse.urljoin(url, link_href)
@@ -227,9 +255,8 @@ class Crawler(object):
                 if config._skip_url(link_href):
                     continue
 
-                # ensure that it is an HTTP link
-                link_parts = urllib.parse.urlparse(link_href)
-                if link_parts.scheme.lower() != "http" and link_parts.scheme.lower() != "https":
+                # ensure that it is an HTTP link (prefix check, no need to parse the whole URL)
+                if not link_href[:8].lower().startswith(('http://', 'https://')):
                     continue
 
                 # strip some URL parameters
@@ -240,16 +267,23 @@ class Crawler(object):
                     config.add_result(id, link_text, link_href, location)
                     unique_urls.add(link_href)
 
-        self.db_conn.commit()
-
         return True
 
 
-def fetch_url(url):
+def make_session():
+    # one pooled connection per fetch thread and host (the default pool keeps 10 and discards the rest)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=fetch_workers, pool_maxsize=fetch_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_url(url, session=None):
     # create request object
     try:
-        # fetch response
-        response = requests.get(url, timeout=15., headers={
+        # fetch response (reusing the session's connections, if given)
+        response = (session or requests).get(url, timeout=15., headers={
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.16; rv:85.0) Gecko/20100101 Firefox/85.0',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
             'Accept-Language': 'en-US,en;q=0.5'
@@ -268,6 +302,21 @@ def fetch_url(url):
     return response.url, response.text
 
 
+def fetch_urls(urls, session=None):
+    # fetch in parallel, yielding fetch_url results in the same order as urls
+    with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        pending = deque()
+        for url in urls:
+            pending.append(executor.submit(fetch_url, url, session))
+
+            # only run a little ahead of the caller, so responses do not pile up in memory
+            if len(pending) >= 2 * fetch_workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
 def crawl_sources(db_conn, db_cursor):
     # make crawler
     crawler = Crawler(db_conn, db_cursor)
@@ -288,12 +337,9 @@ def articles_to_crawl(db_cursor):
     return [(int(x['ID']), x['Source']) for x in db_cursor.fetchall()]
 
 
-def fetch_content(request_url, extractor):
+def extract_content(request_url, url, response, extractor):
     meta = {}
 
-    # fetch using python
-    url, response = fetch_url(request_url)
-
     if response is not None:
         # extract content
         el, txt, meta = extractor.extract(response, url)
@@ -316,52 +362,59 @@ def crawl_articles(db_conn, db_cursor):
     # track ids
     successful_ids = []
 
-    for (id, url) in articles:
-        logging.debug('Fetch %d: %s', id, url)
-
-        # crawl it
-        actual_url, html, txt, meta = fetch_content(url, extractor)
-
-        # figure out canonical url, in case of redirect or meta tags
-        if 'canonical_url' in meta and meta['canonical_url'] != actual_url:
-            canonical_url = meta['canonical_url']
-        elif actual_url:
-            canonical_url = url
-        else:
-            canonical_url = url
-
-        # update the URL if there is a canonical URL
-        if canonical_url != url:
-            try:
-                db_cursor.execute('UPDATE CrawlerQueue SET Source = ?, SourceHash = ? WHERE CrawlerQueue.ID = ?',
-                                  (canonical_url, md5(canonical_url), id))
-            except db.IntegrityError:
-                # URL is already crawled, remove new CrawlerQueueEntry and continue
-                db_cursor.execute('DELETE FROM CrawlerQueue WHERE ID = ?', (id,))
-                continue
-
-        # has response
-        placeholder = True
-        if txt is not None:
-            try:
-                # insert crawler content
-                db_cursor.execute('REPLACE INTO CrawlerContent (QueueID, Text) VALUES (?, ?)', (id, txt))
-
-                # insert
+    # crawl them in parallel, sharing connections
+    with make_session() as session:
+        responses = fetch_urls([x[1] for x in articles], session)
+
+        for i, ((id, url), (response_url, response)) in enumerate(zip(articles, responses)):
+            # commit in batches, rather than once per article
+            if i > 0 and i % commit_batch_size == 0:
                 db_conn.commit()
-                placeholder = False
-
-                # append
-                successful_ids.append(id)
-            except db.InternalError:
-                logging.error('DB encoding error: %d %s', id, url)
-            except db.DataError:
-                logging.error('DB data error (too much text): %d %s', id, url)
-
-        if placeholder:
-            # placeholder row (so it won't crawl again)
-            db_cursor.execute('INSERT OR IGNORE INTO CrawlerContent (QueueID, Text) VALUES (?, ?)', (id, None))
-            db_conn.commit()
+
+            logging.debug('Fetch %d: %s', id, url)
+
+            # extract content
+            actual_url, html, txt, meta = extract_content(url, response_url, response, extractor)
+
+            # figure out canonical url, in case of redirect or meta tags
+            if 'canonical_url' in meta and meta['canonical_url'] != actual_url:
+                canonical_url = meta['canonical_url']
+            elif actual_url:
+                canonical_url = url
+            else:
+                canonical_url = url
+
+            # update the URL if there is a canonical URL
+            if canonical_url != url:
+                try:
+                    db_cursor.execute('UPDATE CrawlerQueue SET Source = ?, SourceHash = ? WHERE CrawlerQueue.ID = ?',
+                                      (canonical_url, md5(canonical_url), id))
+                except db.IntegrityError:
+                    # URL is already crawled, remove new CrawlerQueueEntry and continue
+                    db_cursor.execute('DELETE FROM CrawlerQueue WHERE ID = ?', (id,))
+                    continue
+
+            # has response
+            placeholder = True
+            if txt is not None:
+                try:
+                    # insert crawler content
+                    db_cursor.execute('REPLACE INTO CrawlerContent (QueueID, Text) VALUES (?, ?)', (id, txt))
+                    placeholder = False
+
+                    # append
+                    successful_ids.append(id)
+                except db.InternalError:
+                    logging.error('DB encoding error: %d %s', id, url)
+                except db.DataError:
+                    logging.error('DB data error (too much text): %d %s', id, url)
+
+            if placeholder:
+                # placeholder row (so it won't crawl again)
+                db_cursor.execute('INSERT OR IGNORE INTO CrawlerContent (QueueID, Text) VALUES (?, ?)', (id, None))
+
+    # commit remaining articles
+    db_conn.commit()
 
     return successful_ids
 
@@ -122,8 +122,8 @@ def send_queue_urls(db_cursor):
 
 
 def main():
-    # connect to database
-    conn = common.get_db_connection()
+    # connect to database (only reads)
+    conn = common.get_db_connection(read_only=True)
     c = conn.cursor()
 
     # fetch sources
@@ -1,23 +1,69 @@
 import bs4
+from bs4.builder import LXMLTreeBuilder
 import html
 import math
 import re
 import urllib
 import sys  # used for main
 
-from utility import is_valid_absolute_url, unneeded_tags
+from utility import is_valid_absolute_url, UNNEEDED_TAGS
 
 """
 An HTML -> article text converter inspired by Readability's old open source library. Changes made to reflect our needs
 (less videos, less galleries) and to support more HTML 5 tags.
 """
+class ArticleTreeBuilder(LXMLTreeBuilder):
+    # unneeded tags (and everything inside them) are dropped while parsing, head, title and link are still needed for
+    # the meta data and link tags are unwrapped rather than removed (see ExtractText._remove_unneeded_tags)
+    # comments and processing instructions are never article text, so they are dropped as well
+    skipped_tags = UNNEEDED_TAGS - {'head', 'title', 'link'}
+
+    skip_depth = 0
+
+    def feed(self, markup):
+        self.skip_depth = 0
+        super().feed(markup)
+
+    def start(self, name, attrs, nsmap={}):
+        if self.skip_depth or name in self.skipped_tags:
+            if not self.skip_depth:
+                # end the text before the tag, as if the tag was parsed and extracted afterwards
+                self.soup.endData()
+            self.skip_depth += 1
+            return
+
+        super().start(name, attrs, nsmap)
+
+    def end(self, name):
+        if self.skip_depth:
+            self.skip_depth -= 1
+            return
+
+        super().end(name)
+
+    def data(self, content):
+        if self.skip_depth:
+            return
+
+        super().data(content)
+
+    def comment(self, content):
+        # end the text before the comment, the same as for skipped tags
+        if not self.skip_depth:
+            self.soup.endData()
+
+    def pi(self, target, data):
+        if not self.skip_depth:
+            self.soup.endData()
+
+
 class ExtractText:
     aggressive = True
 
-    unneeded_tags = unneeded_tags()
+    unneeded_tags = UNNEEDED_TAGS
 
-    cleanable_tags = ['form', 'h1']
-    conditionally_cleanable_tags = ['table', 'ul', 'div', 'nav']
+    cleanable_tags = ('form', 'h1')
+    conditionally_cleanable_tags = ('table', 'ul', 'div', 'nav')
 
     score_tag = {'div': 5, 'article': 5, 'pre': 3, 'td': 3, 'blockquote': 3, 'main': 3, 'section': 1, 'span': -1,
                  'header': -3, 'footer': -3, 'address': -3,
@@ -35,25 +81,44 @@ class ExtractText:
     re_skip_div_to_p = re.compile(r'^(a|blockquote|dl|div|img|ol|p|pre|table|ul)', re.IGNORECASE)
     re_double_space = re.compile(r'[ \t]{2,}')
     re_punctuation = re.compile(r'[?.!]')
+    re_sentence_end = re.compile(r'\.(\s|$)')
+    re_heading_tag = re.compile(r'h(\d+)')
+    re_double_newline = re.compile(r'(\n[ \t]*){2,}\n')
+    re_thehill_class = re.compile(r'\b(people-articles|more)\b')
+    re_host_strip = re.compile(r'(^www\.|\:\d+$)')
+    re_absolute_url = re.compile(r'https?://[^\s\[\];?#/][^\s\[\];?#]*(\?[^\s#]+)?(#\S+)?\Z')
+
+    # inner text by element id, only set while the tree is not modified (see extract)
+    _inner_text_cache = None
 
     def __init__(self):
-        pass
+        # decisions by attribute string, class and id strings repeat a lot within a page
+        self._unlikely_cache = {}
+        self._class_weight_cache = {}
+
+        # content scores by element id (see _get_top_score_tag)
+        self._scores = {}
+        self._scored_elements = []
 
     def _site_specific_preprocessing(self, soup, url):
         o = urllib.parse.urlparse(url)
-        host = re.sub(r'(^www\.|\:\d+$)', '', o.netloc.lower())
+        host = self.re_host_strip.sub('', o.netloc.lower())
 
         if host == 'thehill.com':
             # unneeded tags
-            for el in soup.find_all('a', class_=re.compile(r'\b(people-articles|more)\b')):
+            for el in soup.find_all('a', class_=self.re_thehill_class):
                 el.extract()
 
     def extract(self, html, url=None):
+        self._inner_text_cache = None
+        self._unlikely_cache = {}
+        self._class_weight_cache = {}
+
         # pre-process
         clean_html = self._process_html_string(html)
 
         # convert to soup
-        soup = bs4.BeautifulSoup(clean_html, 'lxml')
+        soup = bs4.BeautifulSoup(clean_html, builder=ArticleTreeBuilder)
 
         # site specific
         if url is not None:
@@ -68,38 +133,32 @@ class ExtractText:
         # convert double br to paragraph
         self._convert_double_br_to_p(soup)
 
-        # remove unlikely tags (comments, etc)
+        # remove unlikely tags (comments, etc), changes to the tree are recorded so the less aggressive attempt can
+        # undo them rather than parsing the html again
+        changes = []
         if self.aggressive:
-            self._remove_unlikely_blocks(soup)
-
-        # convert text div elements to p tags
-        self._convert_div_to_p(soup)
+            self._remove_unlikely_blocks(soup, changes)
 
         # get top score element
-        content_el, content_score = self._get_top_score_tag(soup)
+        content_el, content_score = self._find_top_score_tag(soup, changes)
 
-        # no content found?
-        if content_el is None:
+        # no or too little content found?
+        if self.aggressive and (content_el is None or content_score < 10.):
             # try less aggressive
-            if self.aggressive:
-                self.aggressive = False
-                ret = self.extract(html, url)
-                self.aggressive = True
-                return ret
+            self._undo_changes(changes)
+            content_el, content_score = self._find_top_score_tag(soup, None)
 
+        if content_el is None:
             # try cleaning body
             content_el = soup.find('body')
             if content_el is None:
                 return None, None, meta_data
-        elif content_score < 10. and self.aggressive:
-            self.aggressive = False
-            ret = self.extract(html, url)
-            self.aggressive = True
-            return ret
         else:
             # extend to siblings
             content_el = self._find_sibling_tags(soup, content_el)
 
+        self._inner_text_cache = None
+
         # perform clean up
         self._clean_article(content_el, url)
 
@@ -122,7 +181,7 @@ class ExtractText:
 
             if url:
                 # turn into an absolute link
-                tag_canonical_url = urllib.parse.urljoin(url, tag_canonical_url)
+                tag_canonical_url = self._join_url(url, tag_canonical_url)
             elif '://' not in tag_canonical_url:
                 # if not absolute, do not return it
                 tag_canonical_url = None
@@ -132,73 +191,101 @@ class ExtractText:
 
         return ret
 
+    def _join_url(self, url, link):
+        # most links are already absolute, urljoin would parse them only to return them unchanged (links with
+        # characters it normalizes, such as whitespace, empty queries or params, still go through urljoin)
+        if link.isascii() and self.re_absolute_url.match(link):
+            return link
+
+        return urllib.parse.urljoin(url, link)
+
     def _process_html_string(self, html):
         html = self.re_br_close.sub('<br>', html)
 
         return html
 
     def _convert_double_br_to_p(self, soup):
-        found = True
-        while found:
-            found = False
-
-            for el in soup.find_all('br'):
-                ns = el.next_sibling
-                if isinstance(ns, bs4.NavigableString):
-                    if str(ns).strip():
-                        continue
-                    else:
-                        ns = ns.next_sibling
-                if ns is None:
-                    continue
-                if ns.name != 'br':
-                    continue
-
-                found = True
+        # converting a pair never moves <br> tags before each other and never turns an earlier <br> into a pair,
+        # so all tags can be checked in a single pass in document order
+        for el in list(soup.find_all('br')):
+            # already removed as the second <br> of a pair
+            if el.parent is None:
+                continue
 
-                if el.parent.name == 'p':
-                    new_p = soup.new_tag('p')
-                    for nns in list(ns.next_siblings):
-                        new_p.append(nns.extract())
-                    el.parent.insert_after(new_p)
+            ns = el.next_sibling
+            if isinstance(ns, bs4.NavigableString):
+                if str(ns).strip():
+                    continue
                 else:
-                    # move previous siblings
-                    new_p1 = soup.new_tag('p')
-                    for ps in list(el.previous_siblings):
-                        new_p1.insert(0, ps.extract())
+                    ns = ns.next_sibling
+            if ns is None:
+                continue
+            if ns.name != 'br':
+                continue
 
-                    # move next siblings
-                    new_p2 = soup.new_tag('p')
-                    for nns in list(ns.next_siblings):
-                        new_p2.append(nns.extract())
+            if el.parent.name == 'p':
+                new_p = soup.new_tag('p')
+                for nns in list(ns.next_siblings):
+                    new_p.append(nns.extract())
+                el.parent.insert_after(new_p)
+            else:
+                # move previous siblings
+                new_p1 = soup.new_tag('p')
+                for ps in list(el.previous_siblings):
+                    new_p1.insert(0, ps.extract())
 
-                    el.parent.append(new_p1)
-                    el.parent.append(new_p2)
+                # move next siblings
+                new_p2 = soup.new_tag('p')
+                for nns in list(ns.next_siblings):
+                    new_p2.append(nns.extract())
 
-                # remove <br>
-                el.extract()
-                ns.extract()
+                el.parent.append(new_p1)
+                el.parent.append(new_p2)
 
-                break
+            # remove <br>
+            el.extract()
+            ns.extract()
+
+    def _walk_tags(self, root, visit):
+        # single pre-order walk over the tags below root, the children of a tag are skipped if visit returns False
+        stack = list(reversed(root.contents))
+        while stack:
+            el = stack.pop()
+            if not isinstance(el, bs4.element.Tag):
+                continue
+
+            # copy children first, visit may move or remove the tag
+            contents = list(el.contents)
+            if visit(el):
+                stack.extend(reversed(contents))
 
     def _remove_unneeded_tags(self, soup):
-        # unneeded tags
-        for el in soup.find_all(self.unneeded_tags):
-            if el.name == 'link':
-                # parse sometimes view link as open / close tags, can remove important content
-                el.unwrap()
-            else:
+        def visit(el):
+            # unneeded tags
+            if el.name in self.unneeded_tags:
+                if el.name == 'link':
+                    # parse sometimes view link as open / close tags, can remove important content
+                    el.unwrap()
+                    return True
+
                 el.extract()
+                return False
 
-        # hidden tags
-        for el in soup.find_all(style=self.re_display_none):
-            el.extract()
+            # hidden tags
+            style = el.get('style')
+            if style and self.re_display_none.search(style):
+                el.extract()
+                return False
+
+            return True
 
-    def _remove_unlikely_blocks(self, soup):
-        for el in soup.find_all(True):
+        self._walk_tags(soup, visit)
+
+    def _remove_unlikely_blocks(self, soup, changes):
+        def visit(el):
             # skip main tags
             if el.name == 'html' or el.name == 'body':
-                continue
+                return True
 
             # assemble string for matching
             s = el.get('id') or ""
@@ -209,17 +296,42 @@ class ExtractText:
                 else:
                     s += attr_class
 
-            # remove element
-            if self.re_unlikely.search(s) and not self.re_maybe.search(s):
-                el.extract()
+            # remove element (and skip its children, they are removed with it)
+            remove = self._unlikely_cache.get(s)
+            if remove is None:
+                remove = bool((self.re_unlikely.search(s) and not self.re_maybe.search(s)) or self.re_hidden.search(s))
+                self._unlikely_cache[s] = remove
 
-            # remove hidden elements
-            if self.re_hidden.search(s):
+            if remove:
+                changes.append(('extract', el, el.parent, el.parent.index(el)))
                 el.extract()
+                return False
+
+            return True
+
+        self._walk_tags(soup, visit)
+
+    def _convert_div_to_p(self, soup, changes=None):
+        elements = soup.find_all(True)
+
+        # find elements with block level tags inside them in one walk, children before their parents (the pattern
+        # matches tag name prefixes, so it is checked once per name)
+        is_block = {}
+        has_block = set()
+        for el in reversed(elements):
+            block = is_block.get(el.name)
+            if block is None:
+                block = is_block[el.name] = self.re_skip_div_to_p.search(el.name) is not None
+            if block or id(el) in has_block:
+                has_block.add(id(el.parent))
 
-    def _convert_div_to_p(self, soup):
-        for el in soup.find_all('div'):
-            if el.find(self.re_skip_div_to_p) is None:
+        for el in elements:
+            if el.name != 'div':
+                continue
+
+            if id(el) not in has_block:
+                if changes is not None:
+                    changes.append(('rename', el, el.name))
                 el.name = 'p'
             else:
                 # from readability's experimental code
@@ -229,12 +341,53 @@ class ExtractText:
                         p = soup.new_tag('p')
                         p.attrs['style'] = 'display:inline;'
                         child.wrap(p)
+                        if changes is not None:
+                            changes.append(('wrap', p))
+
+    def _undo_changes(self, changes):
+        # in reverse order, so every extracted element goes back to the position it was removed from
+        for change in reversed(changes):
+            if change[0] == 'extract':
+                _, el, parent, index = change
+                parent.insert(index, el)
+            elif change[0] == 'rename':
+                _, el, name = change
+                el.name = name
+            elif change[0] == 'wrap':
+                _, p = change
+                p.unwrap()
+
+        del changes[:]
+
+    def _find_top_score_tag(self, soup, changes):
+        # convert text div elements to p tags
+        self._convert_div_to_p(soup, changes)
+
+        # scoring does not change the text of the tree, so inner text is only calculated once per element
+        self._inner_text_cache = {}
+
+        return self._get_top_score_tag(soup)
 
     def _get_class_weight(self, el):
+        attr_role = el.get('role')
+        attr_class = el.get('class')
+        if isinstance(attr_class, list):
+            attr_class = " ".join(attr_class)
+        attr_id = el.get('id')
+
+        # already scored?
+        key = (attr_role, attr_class, attr_id)
+        score = self._class_weight_cache.get(key)
+        if score is None:
+            score = self._score_class_weight(attr_role, attr_class, attr_id)
+            self._class_weight_cache[key] = score
+
+        return score
+
+    def _score_class_weight(self, attr_role, attr_class, attr_id):
         score = 0.
 
         # score role
-        attr_role = el.get('role')
         if attr_role:
             if attr_role == 'main' or attr_role == 'article':
                 score += 25.
@@ -242,17 +395,13 @@ class ExtractText:
                 score -= 25.
 
         # score class
-        attr_class = el.get('class')
         if attr_class:
-            if isinstance(attr_class, list):
-                attr_class = " ".join(attr_class)
             if self.re_positive_indicators.search(attr_class):
                 score += 25.
             if self.re_negative_indicators.search(attr_class):
                 score -= 25.
 
         # id
-        attr_id = el.get('id')
         if attr_id:
             if self.re_positive_indicators.search(attr_id):
                 score += 25.
@@ -275,26 +424,53 @@ class ExtractText:
         return score
 
     def _get_inner_text(self, el):
+        # already calculated?
+        if self._inner_text_cache is not None:
+            text = self._inner_text_cache.get(id(el))
+            if text is not None:
+                return text
+
         # get text
         text = el.get_text()
 
         # remove spaces
-        text = self.re_double_space.sub(' ', text.strip())
+        text = self._strip_double_spaces(text.strip())
+
+        # unescape (only entities need it)
+        if '&' in text:
+            text = html.unescape(text)
 
-        # unescape
-        text = html.unescape(text)
+        if self._inner_text_cache is not None:
+            self._inner_text_cache[id(el)] = text
 
         return text
 
-    def _add_score_to_tag(self, el, content_score):
-        # get initial score
-        if 'data-etscore' not in el.attrs:
-            el['data-etscore'] = self._initial_score(el)
+    def _strip_double_spaces(self, text):
+        # a match needs a tab or two spaces, so most texts can skip the regular expression
+        if '  ' in text or '\t' in text:
+            return self.re_double_space.sub(' ', text)
 
-        el['data-etscore'] += content_score
+        return text
 
-    def _get_link_density(self, el):
-        text_len = len(self._get_inner_text(el))
+    def _add_score_to_tag(self, el, content_score):
+        # get initial score
+        key = id(el)
+        score = self._scores.get(key)
+        if score is None:
+            score = self._initial_score(el)
+            self._scored_elements.append(el)
+
+        self._scores[key] = score + content_score
+
+    def _first_in_document(self, soup, elements):
+        keys = {id(el) for el in elements}
+        for el in soup.descendants:
+            if id(el) in keys:
+                return el
+
+    def _get_link_density(self, el, text_len=None):
+        if text_len is None:
+            text_len = len(self._get_inner_text(el))
         link_len = 0
 
         # avoid division by zero
@@ -307,9 +483,9 @@ class ExtractText:
         return float(link_len) / float(text_len)
 
     def _get_top_score_tag(self, soup):
-        # reset scores
-        for el in soup.find_all(attrs={'data-etscore': True}):
-            del el['data-etscore']
+        # reset scores (kept by element id rather than as a tag attribute, elements are kept in the order they were scored)
+        self._scores = {}
+        self._scored_elements = []
 
         # get paragraph tags
         for el in soup.find_all('p'):
@@ -324,16 +500,14 @@ class ExtractText:
             content_score = 1.
 
             # add points for commas
-            content_score += float(len(text.split(',')))
+            content_score += float(text.count(',') + 1)
 
             # every one hundred characters adds 1 point, up to 3 points
             content_score += min(math.floor(len(text) / 100), 3.)
 
-            # add to parents
-            for parent in el.parents:
-                if not parent:
-                    break
-
+            # add to parents (walking parent links directly, the score halves at every level so only a few are visited)
+            parent = el.parent
+            while parent is not None:
                 # add score
                 self._add_score_to_tag(parent, content_score)
 
@@ -343,22 +517,38 @@ class ExtractText:
                 if content_score < 1:
                     break
 
+                parent = parent.parent
+
         # scale by link density
-        top_candidate = None
+        top_candidates = []
         top_candidate_score = None
-        for el in soup.find_all(attrs={'data-etscore': True}):
+        for el in self._scored_elements:
+            # the document itself is not a candidate
+            if el is soup:
+                continue
+
             # get link density
             link_density = self._get_link_density(el)
 
             # adjust score
-            el['data-etscore'] *= 1. - link_density
+            score = self._scores[id(el)] * (1. - link_density)
+            self._scores[id(el)] = score
 
             # is top candidate
-            if top_candidate is None or el['data-etscore'] > top_candidate_score:
-                top_candidate = el
-                top_candidate_score = el['data-etscore']
+            if top_candidate_score is None or score > top_candidate_score:
+                top_candidates = [el]
+                top_candidate_score = score
+            elif score == top_candidate_score:
+                top_candidates.append(el)
+
+        if len(top_candidates) == 0:
+            return None, None
+
+        # on a tie, the first candidate in the document wins
+        if len(top_candidates) > 1:
+            return self._first_in_document(soup, top_candidates), top_candidate_score
 
-        return top_candidate, top_candidate_score
+        return top_candidates[0], top_candidate_score
 
     def _find_sibling_tags(self, soup, top_candidate):
         if top_candidate.parent is None:
@@ -366,7 +556,7 @@ class ExtractText:
 
         # make list of elements
         elements = []
-        threshold = max(10., 0.2 * top_candidate['data-etscore'])
+        threshold = max(10., 0.2 * self._scores[id(top_candidate)])
         for el in top_candidate.parent.contents:
             # keep top candidate
             if el == top_candidate:
@@ -379,7 +569,7 @@ class ExtractText:
                 text_len = len(el.string.strip())
 
                 # skip it?
-                if text_len < 80 and re.search(r'\.(\s|$)', el.string) is None:
+                if text_len < 80 and self.re_sentence_end.search(el.string) is None:
                     continue
 
                 # append it
@@ -387,17 +577,18 @@ class ExtractText:
                 continue
 
             # check score
-            if 'data-etscore' not in el.attrs or threshold > el['data-etscore']:
+            score = self._scores.get(id(el))
+            if score is None or threshold > score:
                 continue
 
             if el.name == "p":
                 text = self._get_inner_text(el)
                 text_len = len(text)
-                link_density = self._get_link_density(el)
+                link_density = self._get_link_density(el, text_len)
 
                 if link_density >= 0.25:
                     continue
-                if text_len < 80 and (link_density > 0 or re.search(r'\.(\s|$)', text) is None):
+                if text_len < 80 and (link_density > 0 or self.re_sentence_end.search(text) is None):
                     continue
 
             # append it
@@ -422,7 +613,7 @@ class ExtractText:
         text = self._get_inner_text(el)
 
         # comma count
-        commas = len(text.split(','))
+        commas = text.count(',') + 1
         if commas > 10:
             return False
 
@@ -431,8 +622,8 @@ class ExtractText:
         count_img = len(el.find_all('img'))
         count_li = len(el.find_all('li'))
         count_input = len(el.find_all('input'))
-        link_density = self._get_link_density(el)
         text_len = len(text)
+        link_density = self._get_link_density(el, text_len)
 
         if count_img > count_p:
             return True
@@ -465,12 +656,12 @@ class ExtractText:
         if url is not None:
             for el in content_el.find_all(href=True):
                 try:
-                    el['href'] = urllib.parse.urljoin(url, el['href'])
+                    el['href'] = self._join_url(url, el['href'])
                 except:
                     pass
             for el in content_el.find_all(src=True):
                 try:
-                    el['src'] = urllib.parse.urljoin(url, el['src'])
+                    el['src'] = self._join_url(url, el['src'])
                 except:
                     pass
 
@@ -488,30 +679,49 @@ class ExtractText:
         text = self._element_to_text(el)
 
         # strip double spaces
-        text = self.re_double_space.sub(' ', text)
+        text = self._strip_double_spaces(text)
 
         # strip more than two line breaks
-        text = re.sub(r'(\n[ \t]*){2,}\n', '\n\n', text)
+        text = self.re_double_newline.sub('\n\n', text)
 
         return text.strip()
 
     def _element_to_text(self, el):
-        # is comment?
-        # could potentially suppress bs4.element.PreformattedString
-        if isinstance(el, bs4.element.Comment):
-            return ''
+        if not isinstance(el, bs4.element.Tag):
+            return self._string_to_text(el)
+
+        # walk the tree with an explicit stack rather than recursion, each open tag collects the
+        # text of its children as a list of parts that is joined once the tag is closed
+        stack = [(el, iter(el.contents), [])]
+        while True:
+            tag_el, children, parts = stack[-1]
+            for child in children:
+                if isinstance(child, bs4.element.Tag):
+                    stack.append((child, iter(child.contents), []))
+                    break
+
+                parts.append(self._string_to_text(child))
+            else:
+                stack.pop()
+                text = self._tag_to_text(tag_el, ''.join(parts))
+                if not stack:
+                    return text
 
-        # string?
-        if isinstance(el, bs4.element.NavigableString):
-            # convert to text
-            text = el.string
+                stack[-1][2].append(text)
 
-            # unescape
+    def _string_to_text(self, el):
+        # convert to text (comments are already dropped by ArticleTreeBuilder)
+        text = el.string
+
+        # unescape (only entities need it)
+        if '&' in text:
             return html.unescape(text)
 
+        return text
+
+    def _tag_to_text(self, el, contents):
         # make name lower case
         tag = el.name.lower()
-        contents = ''.join([self._element_to_text(x) for x in el.contents])
 
         # paragraphs
         if tag == 'p':
@@ -534,7 +744,7 @@ class ExtractText:
             return contents.strip() + '\n\n'
 
         # headings
-        m = re.match(r'h(\d+)', tag)
+        m = self.re_heading_tag.match(tag)
         if m:
             return ('#' * int(m.group(1))) + ' ' + contents.strip() + '\n\n'
 
@@ -559,7 +769,7 @@ class ExtractText:
 
 def mode_apply():
     # read all of standard in
-    html = ''.join([l for l in sys.stdin.readlines()])
+    html = sys.stdin.read()
 
     # make extractor
     ex = ExtractText()
@@ -10,6 +10,8 @@ import re
 
 re_line = re.compile(r'\n+')
 re_is_paragraph = re.compile(r'[A-Z].*[a-z].+[\.!\?]')
+re_upper = re.compile(r'[A-Z]')
+re_lower = re.compile(r'[a-z]')
 re_strip_headings = re.compile(r'^#+ ') # strip markdown headings
 re_strip_format = re.compile(r' \*{1,2}([^\*]+)\*{1,2} ') # strip markdown bold and italic
 re_strip_links = re.compile(r'\[([^\]]+)\]\(https?://[^)]+\)', flags=re.IGNORECASE) # strip markdown links
@@ -20,18 +22,38 @@ def is_paragraph(para):
     if len(para) < 20:
         return False
 
-    # test using regular expression
-    if not re_is_paragraph.search(para):
+    # needs to end a sentence after an upper and a lower case letter and one more character, checked before the
+    # regular expression as most lines without punctuation are not paragraphs
+    sentence_end = max(para.rfind('.'), para.rfind('!'), para.rfind('?'))
+    if sentence_end < 3:
         return False
 
-    return True
+    # test using regular expression (only needed across line breaks, as it does not match them)
+    if '\n' in para:
+        return re_is_paragraph.search(para) is not None
+
+    # same test as the regular expression without backtracking: the sentence needs to end at least two characters
+    # after the first lower case letter that follows the first upper case letter
+    m = re_upper.search(para)
+    if m is None:
+        return False
+
+    m = re_lower.search(para, m.end())
+    if m is None:
+        return False
+
+    return sentence_end > m.end()
 
 
 def generate_paragraphs_from_text(text):
-    # clean markdown
-    text = re_strip_headings.sub('', text)
-    text = re_strip_format.sub(r' \1 ', text)
-    text = re_strip_links.sub(r'\1', text)
+    # clean markdown (each pattern is only run if the text has the characters it needs to match, bold, italic and
+    # links can span lines, so they are stripped from the whole text rather than line by line)
+    if text.startswith('#'):
+        text = re_strip_headings.sub('', text)
+    if ' *' in text:
+        text = re_strip_format.sub(r' \1 ', text)
+    if '](' in text:
+        text = re_strip_links.sub(r'\1', text)
 
     # split into lines
     paragraphs = re_line.split(text)
@@ -4,6 +4,7 @@ Copyright 2021, Count Love Crawler
 Common utility functions.
 """
 
+from functools import lru_cache
 import hashlib
 from urllib.parse import urlparse
 
@@ -22,9 +23,14 @@ def is_valid_absolute_url(url):
     return True
 
 
+UNNEEDED_TAGS = frozenset(['head', 'title', 'meta', 'script', 'noscript', 'style', 'iframe', 'embed', 'object', 'link'])
+
+
 def unneeded_tags():
-    return ['head', 'title', 'meta', 'script', 'noscript', 'style', 'iframe', 'embed', 'object', 'link']
+    return UNNEEDED_TAGS
 
 
+@lru_cache(maxsize=4096)  # the same links are often found on several pages
 def md5(str):
-    return hashlib.md5(str.encode('utf8')).digest()
+    # identifies URLs (CrawlerQueue.SourceHash), not used for security
+    return hashlib.md5(str.encode('utf8'), usedforsecurity=False).digest()